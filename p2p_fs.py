@@ -4,21 +4,91 @@ import sys
 import os
 import argparse
 import socket
-import readline
+import socketserver
 import signal
 import time
-from threading import Thread, Lock
+import json
+import random
+import shutil
+import hashlib
+import io
+import mmap
+import select
+import struct
+import http.client
+import urllib.parse
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock, Condition, Event, local, current_thread
+
+# Reference point for reporting how long a node took from startup to registration
+START_TIME = time.perf_counter()
+
+class ThreadingXMLRPCServer(socketserver.ThreadingMixIn, xmlrpc.server.SimpleXMLRPCServer):
+    """XML-RPC server that handles each request in its own thread
+    Needed when a request makes the node call back into itself or into a
+    node that is waiting on it, e.g. during swarm_fetch
+    """
+    daemon_threads = True
 
 class P2PFileSystem:
-    def __init__(self, port=8000, key=None):
+    def __init__(self, port=8000, key=None, state_dir=None, replicas=0):
         self.port = port
         self.nodes = {}
         self.node_counter = 0
         self.used_ids = set()  # Add a set for used IDs
-        self.file_manager = FileManager()
+        self.file_manager = FileManager(key)
         self.nodes_lock = Lock()
         self.security_key = key
         self.local_node_key = None  # Store the local node's key
+        self.unregistered = {}  # node_key -> time it was unregistered, see heartbeat
+        self.registry = None
+        if state_dir:
+            self.registry = RegistryStore(state_dir)
+            self.load_registry()
+        self.inflight = {}  # node_id -> number of commands currently routed to it
+        self.inflight_lock = Lock()
+        self.replication = ReplicationManager(self, replicas) if replicas else None
+        self.ready = Event()  # Set once the server is listening and self.port is final
+
+    def load_registry(self):
+        """Restore node membership from the on-disk snapshot and journal"""
+        nodes = self.registry.load()
+        now = time.time()
+        with self.nodes_lock:
+            for node_key, node_info in nodes.items():
+                # Give every restored node a full timeout to send its next heartbeat
+                node_info['last_active'] = now
+                self.nodes[node_key] = node_info
+                self.used_ids.add(node_info['id'])
+                self.node_counter = max(self.node_counter, node_info['id'])
+                if node_info['ip'] == '127.0.0.1' and node_info['port'] == self.port:
+                    self.local_node_key = node_key
+        if nodes:
+            print(f"Restored {len(nodes)} nodes from registry")
+
+    def register_local_node(self, hostname, security_key=None):
+        """Register the central node itself
+        A restored registry may still hold the central node under the port of
+        its previous run, which would keep the hostname taken, so that entry
+        is replaced
+        """
+        node_key = f"127.0.0.1:{self.port}"
+        with self.nodes_lock:
+            stale_keys = [key for key, node_info in self.nodes.items()
+                          if node_info['hostname'] == hostname and key != node_key]
+        for stale_key in stale_keys:
+            ip_address, port = stale_key.rsplit(':', 1)
+            self.unregister_node(ip_address, int(port))
+            self.unregistered.pop(stale_key, None)
+        return self.register_node('127.0.0.1', self.port, hostname, security_key)
+
+    def snapshot_registry(self):
+        """Write a registry snapshot and truncate the journal"""
+        if not self.registry:
+            return
+        with self.nodes_lock:
+            self.registry.snapshot(self.nodes)
         
     def get_next_available_id(self):
         # Find the smallest available ID
@@ -42,6 +112,7 @@ class P2PFileSystem:
         node_key = f"{ip_address}:{port}"
         
         with self.nodes_lock:
+            self.unregistered.pop(node_key, None)
             # Check if node already exists, just update timestamp if it does
             if node_key in self.nodes:
                 self.nodes[node_key]['last_active'] = time.time()
@@ -72,17 +143,34 @@ class P2PFileSystem:
             # If this is a local node, store its key
             if ip_address == '127.0.0.1' and port == self.port:
                 self.local_node_key = node_key
+
+            if self.registry:
+                self.registry.append('add', node_key, self.nodes[node_key])
                 
             return {'id': next_id}
 
-    def heartbeat(self, ip_address, port):
-        """Update the last active timestamp for a node"""
+    def heartbeat(self, ip_address, port, hostname=None, security_key=None):
+        """Update the last active timestamp for a node
+        Nodes that pass their hostname are re-registered if they are unknown,
+        e.g. after the central node has restarted without a registry
+        """
         node_key = f"{ip_address}:{port}"
         with self.nodes_lock:
             if node_key in self.nodes:
                 self.nodes[node_key]['last_active'] = time.time()
-                return {'status': 'success'}
+                return {'status': 'success', 'id': self.nodes[node_key]['id']}
+            unregistered_at = self.unregistered.get(node_key)
+        if hostname is None:
             return {'status': 'error', 'message': 'Node not found'}
+        if unregistered_at is not None and time.time() - unregistered_at < 60:
+            # A heartbeat that was in flight while the node exited must not bring it back
+            return {'status': 'error', 'message': 'Node has been unregistered'}
+
+        result = self.register_node(ip_address, port, hostname, security_key)
+        if 'error' in result:
+            return {'status': 'error', 'message': result['error']}
+        print(f"Re-registered node {node_key} as id{result['id']}")
+        return {'status': 'success', 'id': result['id']}
 
     def unregister_node(self, ip_address, port):
         node_key = f"{ip_address}:{port}"
@@ -91,14 +179,26 @@ class P2PFileSystem:
                 node_id = self.nodes[node_key]['id']
                 self.used_ids.remove(node_id)  # Remove ID from the used set
                 del self.nodes[node_key]
-                return {'status': 'success', 'message': f'Node {node_key} has been removed'}
-            return {'status': 'error', 'message': f'Node {node_key} does not exist'}
+                self.unregistered[node_key] = time.time()
+                if self.registry:
+                    self.registry.append('del', node_key)
+            else:
+                return {'status': 'error', 'message': f'Node {node_key} does not exist'}
+        if self.replication:
+            self.replication.forget_node(node_id)
+        return {'status': 'success', 'message': f'Node {node_key} has been removed'}
 
     def cleanup_inactive_nodes(self, timeout=120):  # Increased timeout to 120 seconds
         current_time = time.time()
         inactive_nodes = []
+        inactive_ids = []
         
         with self.nodes_lock:
+            # Forget old tombstones of unregistered nodes
+            for node_key, unregistered_at in list(self.unregistered.items()):
+                if current_time - unregistered_at > timeout:
+                    del self.unregistered[node_key]
+
             for node_key, node_info in list(self.nodes.items()):
                 # Don't clean up the local node
                 if node_key == self.local_node_key:
@@ -106,25 +206,44 @@ class P2PFileSystem:
                     
                 if (current_time - node_info.get('last_active', 0)) > timeout:
                     inactive_nodes.append(node_key)
+                    inactive_ids.append(node_info['id'])
                     self.used_ids.remove(node_info['id'])  # Remove ID from the used set
                     del self.nodes[node_key]
+                    if self.registry:
+                        self.registry.append('del', node_key)
+
+        if self.replication:
+            for node_id in inactive_ids:
+                self.replication.forget_node(node_id)
         
         return inactive_nodes
 
     def start_server(self, port_specified=False):
+        server = self.bind_server(port_specified)
+        self.serve(server)
+
+    def bind_server(self, port_specified=False):
+        """Bind the XML-RPC server and set self.port to the port actually used
+        Port 0 lets the operating system pick a free port
+        """
+        server = ThreadingXMLRPCServer(('0.0.0.0', self.port), allow_none=True,
+                                       requestHandler=FileServingRequestHandler, bind_and_activate=False)
         current_port = self.port
         max_port_attempts = 10  # 最多尝试10个端口
         
+        # Retry the bind on the same server object instead of building a new server per port
         for attempt in range(max_port_attempts):
             try:
-                server = xmlrpc.server.SimpleXMLRPCServer(('0.0.0.0', current_port),
-                                                        allow_none=True)
-                self.port = current_port  # 更新实际使用的端口
+                server.server_address = ('0.0.0.0', current_port)
+                server.server_bind()
+                server.server_activate()
+                self.port = server.server_address[1]  # 更新实际使用的端口
                 break
             except OSError as e:
                 # 如果是端口已被占用的错误
                 if port_specified:
                     # 如果用户指定了端口但端口被占用，则报错退出
+                    server.server_close()
                     print(f"Error: Port {current_port} is already in use. Please specify a different port.")
                     sys.exit(1)
                 else:
@@ -132,14 +251,27 @@ class P2PFileSystem:
                     print(f"Port {current_port} is already in use, trying next port...")
                     current_port += 1
                     if attempt == max_port_attempts - 1:
+                        server.server_close()
                         print(f"Error: Failed to find an available port after {max_port_attempts} attempts.")
                         sys.exit(1)
                     continue
         
+        server.security_key = self.security_key  # Checked by FileServingRequestHandler.do_GET
         server.register_instance(self)
         # Register binary transfer methods
         server.register_function(self.file_manager.binary_read, 'binary_read')
         server.register_function(self.file_manager.binary_write, 'binary_write')
+        server.register_function(self.file_manager.run_batch, 'run_batch')
+        server.register_function(self.file_manager.conditional_read, 'conditional_read')
+        server.register_function(self.file_manager.file_checksum, 'file_checksum')
+        server.register_function(self.file_manager.node_stats, 'node_stats')
+        server.register_function(self.file_manager.du, 'du')
+        server.register_function(self.file_manager.df, 'df')
+        server.register_function(self.file_manager.watch_add, 'watch_add')
+        server.register_function(self.file_manager.watch_poll, 'watch_poll')
+        server.register_function(self.file_manager.watch_remove, 'watch_remove')
+        server.register_function(self.file_manager.swarm_fetch, 'swarm_fetch')
+        server.register_function(self.file_manager.pull_file, 'pull_file')
         # Register heartbeat method explicitly
         server.register_function(self.heartbeat, 'heartbeat')
         server.register_function(self.unregister_node, 'unregister_node')
@@ -148,8 +280,16 @@ class P2PFileSystem:
         server.register_function(self.register_node, 'register_node')
         server.register_function(self.get_help, 'get_help')
         server.register_function(self.route_command, 'route_command')
-        print(f"P2P node started on port {self.port}...")
-        
+        server.register_function(self.batch, 'batch')
+        server.register_function(self.copy_file, 'copy_file')
+        # Allow clients to pack several calls into one request with xmlrpc.client.MultiCall
+        server.register_multicall_functions()
+        elapsed = (time.perf_counter() - START_TIME) * 1000
+        print(f"P2P node started on port {self.port} in {elapsed:.0f} ms...", file=sys.stderr)
+        self.ready.set()
+        return server
+
+    def serve(self, server):
         # Start a thread for self-heartbeat to keep the local node active
         self_heartbeat_thread = Thread(target=self.self_heartbeat, daemon=True)
         self_heartbeat_thread.start()
@@ -172,31 +312,116 @@ class P2PFileSystem:
                 time.sleep(5)
 
     def route_command(self, node_id, command, *args):
+        if not self.replication:
+            return self.call_node(node_id, command, *args)
+
+        if command in ReplicationManager.READ_COMMANDS and args:
+            return self.replication.read(node_id, command, *args)
+        result = self.call_node(node_id, command, *args)
+        self.replication.after_command(node_id, command, args, result)
+        return result
+
+    def call_node(self, node_id, command, *args):
         # Find node information
-        target_node = None
-        
-        with self.nodes_lock:
-            for node_key, node_info in self.nodes.items():
-                if node_info['id'] == node_id:
-                    target_node = node_info.copy()
-                    break
-                    
+        target_node = self.get_node_by_id(node_id)
         if not target_node:
             return f"Error: Node {node_id} does not exist"
-        
-        # Check if it is a local node
-        if target_node['ip'] == '127.0.0.1' and target_node['port'] == self.port:
-            # Local node, execute the command directly
-            return getattr(self.file_manager, command)(*args)
+
+        with self.inflight_lock:
+            self.inflight[node_id] = self.inflight.get(node_id, 0) + 1
+        try:
+            # Check if it is a local node
+            if target_node['ip'] == '127.0.0.1' and target_node['port'] == self.port:
+                # Local node, execute the command directly
+                return getattr(self.file_manager, command)(*args)
+            else:
+                # Remote node, forward the request
+                try:
+                    # Create a proxy using the correct IP and port of the node
+                    proxy = xmlrpc.client.ServerProxy(f"http://{target_node['ip']}:{target_node['port']}")
+                    # Directly call the file management command on the remote node
+                    return getattr(proxy, command)(*args)
+                except Exception as e:
+                    return f"Error: Failed to connect to node {node_id} - {str(e)}"
+        finally:
+            with self.inflight_lock:
+                self.inflight[node_id] -= 1
+
+    def copy_file(self, src_node, src_path, dst_node, dst_path, central_ip):
+        """Copy a file between two nodes without passing it through the caller
+        The destination downloads it over HTTP GET from the least loaded
+        up-to-date copy and moves on to the next copy if that fails.
+        central_ip is the address at which the other nodes reach this node
+        """
+        if self.replication:
+            candidates = self.replication.candidates(src_node, src_path)
         else:
-            # Remote node, forward the request
+            candidates = [(src_node, src_path)]
+
+        result = f"Error: Node {src_node} does not exist"
+        for candidate_id, candidate_path in candidates:
+            source = self.get_node_by_id(candidate_id)
+            if not source:
+                continue
+            ip = central_ip if source['ip'] == '127.0.0.1' else source['ip']
+            # Count the download against the source, so reads avoid it meanwhile
+            with self.inflight_lock:
+                self.inflight[candidate_id] = self.inflight.get(candidate_id, 0) + 1
             try:
-                # Create a proxy using the correct IP and port of the node
-                proxy = xmlrpc.client.ServerProxy(f"http://{target_node['ip']}:{target_node['port']}")
-                # Directly call the file management command on the remote node
-                return getattr(proxy, command)(*args)
-            except Exception as e:
-                return f"Error: Failed to connect to node {node_id} - {str(e)}"
+                result = self.route_command(dst_node, 'pull_file', dst_path, ip, source['port'], candidate_path)
+            finally:
+                with self.inflight_lock:
+                    self.inflight[candidate_id] -= 1
+            if not (isinstance(result, str) and result.startswith('Error: Failed to download')):
+                return result
+        return result
+
+    def get_node_by_id(self, node_id):
+        with self.nodes_lock:
+            for node_key, node_info in self.nodes.items():
+                if node_info['id'] == node_id:
+                    return node_info.copy()
+            return None
+
+    def get_load(self, node_id):
+        with self.inflight_lock:
+            return self.inflight.get(node_id, 0)
+
+    def batch(self, node_id, operations):
+        """Run a list of [command, args] operations on one node in a single round trip
+        Returns the result of each operation in order
+        """
+        return self.route_command(node_id, 'run_batch', operations)
+
+    def fan_out(self, command, *args):
+        """Run a command on every node in parallel"""
+        with self.nodes_lock:
+            nodes = sorted((node_info['id'], node_info['hostname']) for node_info in self.nodes.values())
+        if not nodes:
+            return []
+        with ThreadPoolExecutor(max_workers=min(32, len(nodes))) as executor:
+            futures = [executor.submit(self.call_node, node_id, command, *args) for node_id, _ in nodes]
+            return [{'id': node_id, 'hostname': hostname, 'result': future.result()}
+                    for (node_id, hostname), future in zip(nodes, futures)]
+
+    def du_all(self, path=".", rescan=False):
+        return self.fan_out('du', path, rescan)
+
+    def df_all(self, path="."):
+        return self.fan_out('df', path)
+
+    def watch(self, node_id, path):
+        """Subscribe to changes below a directory on a node
+        Returns a watch ID whose events are collected with watch_events
+        """
+        return self.route_command(node_id, 'watch_add', path)
+
+    def watch_events(self, node_id, watch_id, timeout=25):
+        """Long-poll for the next batch of events of a watch"""
+        return self.route_command(node_id, 'watch_poll', watch_id, timeout)
+
+    def unwatch(self, node_id, watch_id):
+        return self.route_command(node_id, 'watch_remove', watch_id)
 
     def get_nodes(self):
         with self.nodes_lock:
@@ -230,6 +455,18 @@ File Operation Commands (requires node ID or hostname prefix):
   echo idNode:path content - Write content to a file
   cp srcIdNode:path dstIdNode:path - Copy a file
   mv srcIdNode:path dstIdNode:path - Move a file
+  swarmcp srcIdNode:path [srcIdNode:path ...] dstIdNode:path
+                           - Copy a file from several replicas in parallel
+  watch idNode:path [seconds] - Print changes below a directory (default 30 seconds)
+  du [-r] idNode:path      - Show the size of a directory and its subdirectories
+  du [-r] path             - Show the size of a directory on every node
+                             (-r rescans changes made outside the file system)
+  df [idNode]              - Show disk space on one node or on every node
+  batch idNode             - Read commands from stdin until 'end' and run
+                             them on the node in one round trip, e.g.
+                               touch /a.txt
+                               echo /b.txt content
+                               cp /a.txt /c.txt
 
 Examples:
   mkdir id1:/test       - Create /test directory on node 1
@@ -275,7 +512,753 @@ Note: All path operations require a node ID or hostname prefix.
     def pwd(self, path="."):
         return self.file_manager.pwd(path)
 
+class RegistryStore:
+    """Persist node membership as a snapshot file plus an append-only journal"""
+
+    def __init__(self, state_dir):
+        os.makedirs(state_dir, exist_ok=True)
+        self.snapshot_path = os.path.join(state_dir, 'registry.json')
+        self.journal_path = os.path.join(state_dir, 'registry.journal')
+        self.journal = None
+        self.pending = 0  # Journal entries written since the last snapshot
+
+    def load(self):
+        nodes = {}
+        try:
+            with open(self.snapshot_path, 'r') as f:
+                nodes = json.load(f)['nodes']
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError) as e:
+            print(f"Warning: Ignoring corrupt registry snapshot - {str(e)}")
+
+        try:
+            with open(self.journal_path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A torn write can only affect the last line
+                        break
+                    if entry['op'] == 'add':
+                        nodes[entry['key']] = entry['node']
+                    elif entry['op'] == 'del':
+                        nodes.pop(entry['key'], None)
+                    self.pending += 1
+        except FileNotFoundError:
+            pass
+        return nodes
+
+    def append(self, op, node_key, node_info=None):
+        if self.journal is None:
+            self.journal = open(self.journal_path, 'a')
+        entry = {'op': op, 'key': node_key}
+        if node_info is not None:
+            entry['node'] = {k: node_info[k] for k in ('id', 'hostname', 'ip', 'port')}
+        self.journal.write(json.dumps(entry) + '\n')
+        self.journal.flush()
+        self.pending += 1
+
+    def snapshot(self, nodes):
+        if not self.pending:
+            return
+        data = {'nodes': {node_key: {k: node_info[k] for k in ('id', 'hostname', 'ip', 'port')}
+                          for node_key, node_info in nodes.items()}}
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        # The snapshot now covers every journal entry, so start a fresh journal
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = open(self.journal_path, 'w')
+        self.pending = 0
+
+class ReplicationManager:
+    """Keep asynchronous copies of files written through the central node
+    Each file written on a node is copied to `copies` other nodes, picked by
+    free disk space and load, under REPLICA_DIR/<hostname>/<path>. Reads go
+    to the least loaded node that holds an up-to-date copy
+    """
+    REPLICA_DIR = '.p2p_replicas'
+    # Index of the written path in the arguments of each command that changes a file
+    WRITE_COMMANDS = {'echo': 0, 'touch': 0, 'binary_write': 0, 'cp': 1, 'mv': 1, 'swarm_fetch': 0,
+                      'pull_file': 0}
+    READ_COMMANDS = ('cat', 'binary_read', 'conditional_read', 'file_checksum')
+
+    def __init__(self, p2p_system, copies, stats_ttl=30):
+        self.p2p_system = p2p_system
+        self.copies = copies
+        self.stats_ttl = stats_ttl
+        self.replicas = {}  # (node_id, path) -> {'version': n, 'nodes': {node_id: replica path}}
+        self.version_counter = 0
+        self.stats = {}  # node_id -> (fetch time, node_stats result)
+        self.lock = Lock()
+        self.executor = ThreadPoolExecutor(max_workers=4)
+
+    @staticmethod
+    def is_error(result):
+        return isinstance(result, str) and result.startswith('Error')
+
+    def after_command(self, node_id, command, args, result):
+        if command == 'run_batch':
+            if isinstance(result, list):
+                for (op_command, op_args), op_result in zip(args[0], result):
+                    self.after_command(node_id, op_command, op_args, op_result)
+            return
+        if self.is_error(result):
+            return
+        if command in ('rm', 'mv'):
+            self.drop(node_id, args[0])
+        if command in self.WRITE_COMMANDS and len(args) > self.WRITE_COMMANDS[command]:
+            self.schedule(node_id, args[self.WRITE_COMMANDS[command]])
+
+    def schedule(self, node_id, path):
+        key = (node_id, os.path.normpath(path))
+        with self.lock:
+            self.version_counter += 1
+            entry = self.replicas.setdefault(key, {'version': 0, 'nodes': {}})
+            entry['version'] = version = self.version_counter
+            # Existing copies are stale until the new content reaches them
+            previous = list(entry['nodes'])
+            entry['nodes'] = {}
+        self.executor.submit(self.replicate, key, version, previous)
+
+    def replicate(self, key, version, previous):
+        node_id, path = key
+        try:
+            primary = self.p2p_system.get_node_by_id(node_id)
+            if not primary:
+                return
+            targets = [target for target in previous if self.p2p_system.get_node_by_id(target)]
+            if len(targets) < self.copies:
+                targets += self.place([node_id] + targets, self.copies - len(targets))
+
+            content = self.p2p_system.call_node(node_id, 'binary_read', path)
+            if self.is_error(content):
+                return
+            replica_path = os.path.join(self.REPLICA_DIR, primary['hostname'], path.lstrip('/\\'))
+            for target in targets:
+                result = self.p2p_system.call_node(target, 'binary_write', replica_path, content)
+                if self.is_error(result):
+                    print(f"Replication of id{node_id}:{path} to node {target} failed: {result}")
+                    continue
+                with self.lock:
+                    entry = self.replicas.get(key)
+                    if entry and entry['version'] == version:
+                        entry['nodes'][target] = replica_path
+        except Exception as e:
+            print(f"Replication of id{node_id}:{path} failed: {str(e)}")
+
+    def place(self, exclude, count):
+        """Pick the nodes with the most free space, then the lowest load"""
+        with self.p2p_system.nodes_lock:
+            candidates = [node_info['id'] for node_info in self.p2p_system.nodes.values()
+                          if node_info['id'] not in exclude]
+        scored = []
+        for node_id in candidates:
+            stats = self.node_stats(node_id)
+            if stats is None:
+                continue
+            scored.append((-stats['free_mb'], stats['load'] + self.p2p_system.get_load(node_id), node_id))
+        return [node_id for _, _, node_id in sorted(scored)[:count]]
+
+    def node_stats(self, node_id):
+        cached = self.stats.get(node_id)
+        if cached and time.time() - cached[0] < self.stats_ttl:
+            return cached[1]
+        stats = self.p2p_system.call_node(node_id, 'node_stats')
+        if self.is_error(stats):
+            stats = None
+        self.stats[node_id] = (time.time(), stats)
+        return stats
+
+    def candidates(self, node_id, path):
+        """Return (node_id, path) of every up-to-date copy, least loaded first"""
+        with self.lock:
+            entry = self.replicas.get((node_id, os.path.normpath(path)))
+            copies = list(entry['nodes'].items()) if entry else []
+        # sorted() is stable, so the primary wins ties
+        return sorted([(node_id, path)] + copies, key=lambda c: self.p2p_system.get_load(c[0]))
+
+    def read(self, node_id, command, path, *args):
+        """Serve a read from the least loaded up-to-date copy
+        Falls through to the next copy if the primary cannot be reached or a
+        copy fails in any way. Failed copies are no longer used
+        """
+        primary_result = None
+        for candidate_id, candidate_path in self.candidates(node_id, path):
+            result = self.p2p_system.call_node(candidate_id, command, candidate_path, *args)
+            if not self.is_error(result):
+                return result
+            if candidate_id == node_id:
+                primary_result = result
+                if not result.startswith(('Error: Failed to connect', 'Error: Node')):
+                    return result
+            else:
+                self.discard(node_id, path, candidate_id)
+        # The primary's error says more than that of a copy
+        return primary_result or result
+
+    def discard(self, node_id, path, replica_node):
+        """Stop reading node_id:path from a copy that turned out to be unusable"""
+        with self.lock:
+            entry = self.replicas.get((node_id, os.path.normpath(path)))
+            if entry:
+                entry['nodes'].pop(replica_node, None)
+
+    def forget_node(self, node_id):
+        """Drop everything known about a node that left, its ID may be reused"""
+        with self.lock:
+            for key in [key for key in self.replicas if key[0] == node_id]:
+                del self.replicas[key]
+            for entry in self.replicas.values():
+                entry['nodes'].pop(node_id, None)
+            self.stats.pop(node_id, None)
+
+    def drop(self, node_id, path):
+        with self.lock:
+            entry = self.replicas.pop((node_id, os.path.normpath(path)), None)
+        if entry:
+            for replica_node, replica_path in entry['nodes'].items():
+                self.executor.submit(self.p2p_system.call_node, replica_node, 'rm', replica_path)
+
+class ReadCache:
+    """Local read-through cache of remote files
+    File contents are stored by content hash and evicted in LRU order once
+    the cache grows beyond max_bytes
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # 'node_id:path' -> size, mtime and hash, oldest first
+        self.refs = {}  # hash -> number of entries sharing that content
+        self.total_bytes = 0
+        self.lock = Lock()
+
+        try:
+            with open(self.index_path, 'r') as f:
+                entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            entries = []
+        for key, entry in entries:
+            if os.path.isfile(self.blob_path(entry['hash'])):
+                self.add_entry(key, entry)
+
+    def blob_path(self, digest):
+        return os.path.join(self.cache_dir, digest)
+
+    def add_entry(self, key, entry):
+        self.entries[key] = entry
+        if self.refs.get(entry['hash'], 0) == 0:
+            self.total_bytes += entry['size']
+        self.refs[entry['hash']] = self.refs.get(entry['hash'], 0) + 1
+
+    def remove_entry(self, key):
+        entry = self.entries.pop(key)
+        self.refs[entry['hash']] -= 1
+        if self.refs[entry['hash']] == 0:
+            del self.refs[entry['hash']]
+            self.total_bytes -= entry['size']
+            try:
+                os.remove(self.blob_path(entry['hash']))
+            except FileNotFoundError:
+                pass
+
+    def save_index(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(list(self.entries.items()), f)
+        os.replace(tmp_path, self.index_path)
+
+    def read(self, server, node_id, path):
+        """Return the file as xmlrpc.client.Binary, or an error string
+        The source node is asked whether the cached copy is still current and
+        only sends the content when it has changed
+        """
+        key = f"{node_id}:{path}"
+        with self.lock:
+            entry = dict(self.entries.get(key, {}))
+
+        result = server.route_command(node_id, 'conditional_read', path,
+                                      entry.get('size', -1), entry.get('mtime', 0), entry.get('hash', ''))
+        if isinstance(result, str):
+            return result
+
+        if result['status'] == 'unchanged':
+            try:
+                with open(self.blob_path(result['hash']), 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                # Evicted by another thread in the meantime, fetch unconditionally
+                result = server.route_command(node_id, 'conditional_read', path)
+                if isinstance(result, str):
+                    return result
+            else:
+                with self.lock:
+                    if key in self.entries:
+                        # The mtime may have moved while the content stayed the same
+                        self.entries[key]['mtime'] = result['mtime']
+                        self.entries.move_to_end(key)
+                return xmlrpc.client.Binary(data)
+
+        self.store(key, result)
+        return result['data']
+
+    def store(self, key, result):
+        data = result['data'].data
+        if len(data) > self.max_bytes:
+            return
+        entry = {'size': result['size'], 'mtime': result['mtime'], 'hash': result['hash']}
+        with self.lock:
+            if key in self.entries:
+                self.remove_entry(key)
+            blob_path = self.blob_path(entry['hash'])
+            if entry['hash'] not in self.refs:
+                with open(blob_path + '.tmp', 'wb') as f:
+                    f.write(data)
+                os.replace(blob_path + '.tmp', blob_path)
+            self.add_entry(key, entry)
+            while self.total_bytes > self.max_bytes:
+                self.remove_entry(next(iter(self.entries)))
+            self.save_index()
+
+class FileServingRequestHandler(xmlrpc.server.SimpleXMLRPCRequestHandler):
+    """Request handler that also serves raw file contents over HTTP GET
+    GET /file?path=<path> supports single Range requests. The body is sent
+    straight from the page cache with sendfile where the platform has it,
+    and from a memory map otherwise, so large reads are never copied into a
+    Python bytes object, base64-encoded or wrapped in XML. Nodes started
+    with --key only serve requests that send it in the X-P2P-Key header
+    """
+
+    def do_GET(self):
+        security_key = getattr(self.server, 'security_key', None)
+        if security_key and self.headers.get('X-P2P-Key') != security_key:
+            self.send_error(403, 'Security key verification failed')
+            return
+
+        url = urllib.parse.urlsplit(self.path)
+        paths = urllib.parse.parse_qs(url.query).get('path')
+        if url.path != '/file' or not paths:
+            self.send_error(404)
+            return
+
+        try:
+            f = open(paths[0], 'rb')
+        except OSError as e:
+            self.send_error(404, str(e))
+            return
+
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            offset, length = 0, size
+            range_header = self.headers.get('Range')
+            if range_header:
+                try:
+                    start, end = range_header.replace('bytes=', '', 1).split('-')
+                    offset = int(start)
+                    end = min(int(end), size - 1) if end else size - 1
+                    length = end - offset + 1
+                    if offset >= size or length <= 0:
+                        raise ValueError
+                except ValueError:
+                    self.send_error(416)
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', f"bytes {offset}-{offset + length - 1}/{size}")
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(length))
+            self.end_headers()
+
+            if length == 0:
+                return
+            # wfile is buffered, the headers must reach the socket before the body
+            self.wfile.flush()
+            if hasattr(os, 'sendfile'):
+                self.connection.sendfile(f, offset, length)
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    view = memoryview(mapped)
+                    try:
+                        for start in range(offset, offset + length, 1024 * 1024):
+                            self.connection.sendall(view[start:min(start + 1024 * 1024, offset + length)])
+                    finally:
+                        view.release()
+
+def fetch_range(ip, port, path, offset, length, f, key=None, timeout=30):
+    """Download length bytes at offset of path on a node into file object f
+    A length of None downloads the whole file. Returns the number of bytes written.
+    A source that sends nothing for timeout seconds raises instead of blocking forever
+    """
+    query = urllib.parse.urlencode({'path': path})
+    headers = {'X-P2P-Key': key} if key else {}
+    if length is not None:
+        headers['Range'] = f"bytes={offset}-{offset + length - 1}"
+    connection = http.client.HTTPConnection(ip, port, timeout=timeout)
+    try:
+        connection.request('GET', f"/file?{query}", headers=headers)
+        response = connection.getresponse()
+        if response.status not in (200, 206):
+            raise OSError(f"HTTP {response.status} {response.reason}")
+        if response.status == 200 and offset:
+            raise OSError("Server ignored the range request")
+        if length is None:
+            length = int(response.getheader('Content-Length'))
+        remaining = length
+        while remaining:
+            block = response.read(min(remaining, 1024 * 1024))
+            if not block:
+                raise OSError("Connection closed before the range was complete")
+            f.write(block)
+            remaining -= len(block)
+        return length
+    finally:
+        connection.close()
+
+# inotify(7) constants, see /usr/include/sys/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENTS = {
+    IN_CREATE: 'created',
+    IN_CLOSE_WRITE: 'modified',
+    IN_DELETE: 'deleted',
+    IN_MOVED_FROM: 'moved_from',
+    IN_MOVED_TO: 'moved_to',
+}
+
+class DirectoryWatch:
+    """Collect change events for a directory tree
+    Uses inotify where the C library provides it and falls back to
+    comparing periodic scandir snapshots elsewhere
+    """
+    max_events = 10000
+
+    def __init__(self, path):
+        self.path = path
+        self.events = deque()
+        self.overflow = False
+        self.condition = Condition()
+        self.running = True
+        self.last_poll = time.time()
+        self.libc = self.load_libc()
+        self.backend = 'inotify' if self.libc else 'polling'
+        target = self.run_inotify if self.libc else self.run_polling
+        self.thread = Thread(target=target, daemon=True)
+
+    @staticmethod
+    def load_libc():
+        if not sys.platform.startswith('linux'):
+            return None
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.inotify_init1, libc.inotify_add_watch, libc.inotify_rm_watch
+            return libc
+        except (ImportError, OSError, AttributeError):
+            return None
+
+    def emit(self, event, path):
+        with self.condition:
+            if len(self.events) >= self.max_events:
+                self.overflow = True
+            else:
+                self.events.append({'event': event, 'path': path})
+            self.condition.notify_all()
+
+    def poll(self, timeout, batch_window=0.1):
+        """Wait up to timeout seconds for events and return them as one batch"""
+        self.last_poll = time.time()
+        with self.condition:
+            if not self.events and not self.overflow:
+                self.condition.wait(timeout)
+        if self.events:
+            # Let events that arrive together (e.g. create + write) land in the same batch
+            time.sleep(batch_window)
+        with self.condition:
+            events, overflow = [], self.overflow
+            while self.events:
+                event = self.events.popleft()
+                if not events or events[-1] != event:
+                    events.append(event)
+            self.overflow = False
+        self.last_poll = time.time()
+        return {'events': events, 'overflow': overflow}
+
+    def stop(self):
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+
+    def run_inotify(self):
+        fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            self.run_polling()
+            return
+        mask = IN_CREATE | IN_CLOSE_WRITE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF
+        watch_dirs = {}
+
+        def add_tree(root, emit_entries=False):
+            """Watch root and every directory below it
+            For a directory created or moved in while watching, entries that
+            appeared before its watch was added are reported as created
+            """
+            stack = [root]
+            while stack:
+                dirpath = stack.pop()
+                # Add the watch before listing, so no entry falls between the two
+                wd = self.libc.inotify_add_watch(fd, os.fsencode(dirpath), mask)
+                if wd < 0:
+                    continue
+                watch_dirs[wd] = dirpath
+                try:
+                    with os.scandir(dirpath) as it:
+                        for entry in it:
+                            if emit_entries:
+                                self.emit('created', entry.path)
+                            if entry.is_dir(follow_symlinks=False):
+                                stack.append(entry.path)
+                except OSError:
+                    continue
+
+        def remove_tree(root):
+            """Stop watching root and every directory below it"""
+            prefix = os.path.join(root, '')
+            for wd, dirpath in list(watch_dirs.items()):
+                if dirpath == root or dirpath.startswith(prefix):
+                    del watch_dirs[wd]
+                    self.libc.inotify_rm_watch(fd, wd)
+
+        try:
+            add_tree(self.path)
+            root_wd = next(iter(watch_dirs), None)
+            while self.running:
+                ready, _, _ = select.select([fd], [], [], 1)
+                if not ready:
+                    continue
+                try:
+                    data = os.read(fd, 65536)
+                except BlockingIOError:
+                    continue
+                offset = 0
+                while offset < len(data):
+                    wd, event_mask, cookie, length = struct.unpack_from('iIII', data, offset)
+                    name = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b'\0'))
+                    offset += 16 + length
+
+                    if event_mask & IN_Q_OVERFLOW:
+                        with self.condition:
+                            self.overflow = True
+                            self.condition.notify_all()
+                        continue
+                    if event_mask & IN_IGNORED:
+                        watch_dirs.pop(wd, None)
+                        continue
+                    if wd not in watch_dirs:
+                        continue
+                    if event_mask & IN_DELETE_SELF:
+                        # Children are reported by their parent, only the root needs this
+                        if wd == root_wd:
+                            self.emit('deleted', self.path)
+                        continue
+
+                    path = os.path.join(watch_dirs[wd], name)
+                    for flag, event in INOTIFY_EVENTS.items():
+                        if event_mask & flag:
+                            self.emit(event, path)
+                    if event_mask & IN_ISDIR and event_mask & IN_MOVED_FROM:
+                        # Moved away or renamed, the new name gets fresh watches on IN_MOVED_TO
+                        remove_tree(path)
+                    if event_mask & IN_ISDIR and event_mask & (IN_CREATE | IN_MOVED_TO):
+                        add_tree(path, emit_entries=True)
+        finally:
+            os.close(fd)
+
+    def snapshot(self):
+        entries = {}
+        stack = [self.path]
+        while stack:
+            current = stack.pop()
+            try:
+                with os.scandir(current) as it:
+                    for entry in it:
+                        try:
+                            st = entry.stat(follow_symlinks=False)
+                        except OSError:
+                            continue
+                        entries[entry.path] = (st.st_mtime_ns, st.st_size)
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+            except OSError:
+                continue
+        return entries
+
+    def run_polling(self, interval=1):
+        previous = self.snapshot()
+        while self.running:
+            time.sleep(interval)
+            current = self.snapshot()
+            for path in current.keys() - previous.keys():
+                self.emit('created', path)
+            for path in previous.keys() - current.keys():
+                self.emit('deleted', path)
+            for path in current.keys() & previous.keys():
+                if current[path] != previous[path] and not os.path.isdir(path):
+                    self.emit('modified', path)
+            previous = current
+
+class WatchManager:
+    """Track the directory watches of one node, keyed by watch ID"""
+
+    def __init__(self, expiry=300):
+        self.watches = {}
+        self.watch_counter = 0
+        self.lock = Lock()
+        self.expiry = expiry  # Drop watches whose subscriber stopped polling
+
+    def add(self, path):
+        self.expire()
+        watch = DirectoryWatch(path)
+        with self.lock:
+            self.watch_counter += 1
+            watch_id = self.watch_counter
+            self.watches[watch_id] = watch
+        watch.thread.start()
+        return watch_id, watch.backend
+
+    def get(self, watch_id):
+        with self.lock:
+            return self.watches.get(watch_id)
+
+    def remove(self, watch_id):
+        with self.lock:
+            watch = self.watches.pop(watch_id, None)
+        if watch:
+            watch.stop()
+        return watch is not None
+
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            stale = [watch_id for watch_id, watch in self.watches.items()
+                     if now - watch.last_poll > self.expiry]
+        for watch_id in stale:
+            self.remove(watch_id)
+
+class UsageTracker:
+    """Recursive size of directories for du
+    A tree is measured by one scandir walk the first time it is queried and
+    then kept current by the FileManager operations that change it. Changes
+    made outside of FileManager are only picked up by a rescan
+    """
+
+    def __init__(self):
+        self.sizes = {}  # absolute directory path -> total size of the files below it
+        self.lock = Lock()
+
+    def walk(self, path, sizes):
+        total = 0
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        total += self.walk(entry.path, sizes)
+                    else:
+                        total += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    continue
+        sizes[path] = total
+        return total
+
+    def usage(self, path, rescan=False):
+        """Return the size of a directory and of each of its subdirectories"""
+        path = os.path.abspath(path)
+        with self.lock:
+            known = path in self.sizes
+        if rescan or not known:
+            sizes = {}
+            self.walk(path, sizes)
+            with self.lock:
+                if rescan and known:
+                    # Pass the correction on to the ancestors that include this tree
+                    self.add_to_ancestors(path, sizes[path] - self.sizes[path])
+                self.sizes.update(sizes)
+
+        children = []
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    with self.lock:
+                        size = self.sizes.get(entry.path)
+                    if size is None:
+                        # Created outside of FileManager since the last walk
+                        size = self.usage(entry.path)[0]
+                    children.append((entry.name, size))
+        with self.lock:
+            return self.sizes[path], sorted(children)
+
+    def add_to_ancestors(self, path, delta):
+        parent = os.path.dirname(path)
+        while parent != path:
+            if parent in self.sizes:
+                self.sizes[parent] += delta
+            path, parent = parent, os.path.dirname(parent)
+
+    def size_of(self, path):
+        """Current size of a file or tree, 0 if nothing is tracked"""
+        if not self.sizes or not os.path.lexists(path):
+            return 0
+        path = os.path.abspath(path)
+        if os.path.isdir(path) and not os.path.islink(path):
+            with self.lock:
+                size = self.sizes.get(path)
+            return size if size is not None else self.walk(path, {})
+        return os.lstat(path).st_size
+
+    def changed(self, path, old_size):
+        """Account for a file or tree at path whose size was old_size before the change"""
+        if not self.sizes:
+            return
+        path = os.path.abspath(path)
+        new_size = self.size_of(path)
+        with self.lock:
+            # New directories on the way are measured when du first reaches them
+            self.add_to_ancestors(path, new_size - old_size)
+
+    def forget(self, path):
+        """Drop a removed or moved tree, its size must already be accounted for"""
+        prefix = os.path.join(os.path.abspath(path), '')
+        with self.lock:
+            for directory in [d for d in self.sizes if d == prefix[:-1] or d.startswith(prefix)]:
+                del self.sizes[directory]
+
 class FileManager:
+    # Commands that may be run through run_batch
+    BATCH_COMMANDS = ('mkdir', 'rm', 'touch', 'ls', 'tree', 'cat', 'pwd', 'echo', 'cp', 'mv',
+                      'binary_read', 'binary_write')
+
+    def __init__(self, security_key=None):
+        self.security_key = security_key  # Sent when downloading from other nodes over HTTP GET
+        self.watches = WatchManager()
+        self.usage = UsageTracker()
+
     def pwd(self, path="."):
         try:
             # 获取绝对路径
@@ -286,7 +1269,10 @@ class FileManager:
             
     def mkdir(self, path):
         try:
+            # The directory may already exist and hold files
+            old_size = self.usage.size_of(path)
             os.makedirs(path, exist_ok=True)
+            self.usage.changed(path, old_size)
             return f"Directory '{path}' created successfully"
         except Exception as e:
             return f"Error: Failed to create directory - {str(e)}"
@@ -295,9 +1281,12 @@ class FileManager:
         try:
             if os.path.isdir(path):
                 os.rmdir(path)
+                self.usage.forget(path)
                 return f"Directory '{path}' removed successfully"
             elif os.path.isfile(path):
+                old_size = self.usage.size_of(path)
                 os.remove(path)
+                self.usage.changed(path, old_size)
                 return f"File '{path}' removed successfully"
             else:
                 return f"Error: '{path}' does not exist"
@@ -306,8 +1295,10 @@ class FileManager:
 
     def touch(self, path):
         try:
+            old_size = self.usage.size_of(path)
             with open(path, 'a'):
                 os.utime(path, None)
+            self.usage.changed(path, old_size)
             return f"File '{path}' created successfully"
         except Exception as e:
             return f"Error: Failed to create file - {str(e)}"
@@ -370,8 +1361,10 @@ class FileManager:
     def echo(self, path, content):
         try:
             os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            old_size = self.usage.size_of(path)
             with open(path, 'w') as f:
                 f.write(content)
+            self.usage.changed(path, old_size)
             return f"Content written to '{path}'"
         except Exception as e:
             return f"Error: Failed to write to file - {str(e)}"
@@ -383,9 +1376,11 @@ class FileManager:
                 dst_dir = os.path.dirname(os.path.abspath(dst_path))
                 os.makedirs(dst_dir, exist_ok=True)
                 
+                old_size = self.usage.size_of(dst_path)
                 with open(src_path, 'rb') as src:
                     with open(dst_path, 'wb') as dst:
                         dst.write(src.read())
+                self.usage.changed(dst_path, old_size)
                 return f"Copied '{src_path}' to '{dst_path}'"
             else:
                 return f"Error: Source file '{src_path}' does not exist or is not a file"
@@ -401,7 +1396,13 @@ class FileManager:
             dst_dir = os.path.dirname(os.path.abspath(dst_path))
             os.makedirs(dst_dir, exist_ok=True)
             
+            src_size = self.usage.size_of(src_path)
+            dst_size = self.usage.size_of(dst_path)
             os.rename(src_path, dst_path)
+            self.usage.changed(src_path, src_size)
+            self.usage.forget(src_path)
+            self.usage.forget(dst_path)
+            self.usage.changed(dst_path, dst_size)
             return f"Moved '{src_path}' to '{dst_path}'"
         except Exception as e:
             return f"Error: Failed to move file - {str(e)}"
@@ -413,27 +1414,224 @@ class FileManager:
         except Exception as e:
             return f"Error: Failed to read file - {str(e)}"
 
+    def run_batch(self, operations):
+        results = []
+        for operation in operations:
+            try:
+                command, args = operation
+                if command not in self.BATCH_COMMANDS:
+                    results.append(f"Error: Invalid command '{command}'")
+                    continue
+                results.append(getattr(self, command)(*args))
+            except Exception as e:
+                results.append(f"Error: Batch operation failed - {str(e)}")
+        return results
+
+    def conditional_read(self, path, size=-1, mtime=0, digest=''):
+        """Read a file only if it differs from the caller's cached copy
+        A matching size and mtime is trusted without hashing the file
+        """
+        try:
+            st = os.stat(path)
+            if digest and st.st_size == size and st.st_mtime == mtime:
+                return {'status': 'unchanged', 'size': size, 'mtime': mtime, 'hash': digest}
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Sizes travel as floats, XML-RPC integers are limited to 32 bits
+            info = {'size': float(len(data)), 'mtime': st.st_mtime, 'hash': hashlib.sha256(data).hexdigest()}
+            if info['hash'] == digest:
+                info['status'] = 'unchanged'
+            else:
+                info['status'] = 'modified'
+                info['data'] = xmlrpc.client.Binary(data)
+            return info
+        except Exception as e:
+            return f"Error: Failed to read file - {str(e)}"
+
+    def file_checksum(self, path):
+        try:
+            digest = hashlib.sha256()
+            size = 0
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(block)
+                    size += len(block)
+            return {'size': float(size), 'hash': digest.hexdigest()}
+        except Exception as e:
+            return f"Error: Failed to read file - {str(e)}"
+
+    def swarm_fetch(self, dst_path, sources, chunk_size=4 * 1024 * 1024):
+        """Download one file from several replicas in parallel
+        sources is a list of [ip, port, path]; replicas whose checksum differs
+        from the first reachable source are ignored. Each source fetches the
+        next missing chunk until none are left, and the assembled file is
+        verified against the checksum before it replaces dst_path
+        """
+        try:
+            checksums = []
+            with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+                futures = [executor.submit(self.remote_checksum, ip, port, path) for ip, port, path in sources]
+                for (ip, port, path), future in zip(sources, futures):
+                    checksums.append(((ip, port, path), future.result()))
+
+            replicas = [(source, info) for source, info in checksums if isinstance(info, dict)]
+            if not replicas:
+                return f"Error: No source is available - {checksums[0][1]}"
+            expected = replicas[0][1]
+            replicas = [source for source, info in replicas if info['hash'] == expected['hash']]
+            source_count = len(replicas)
+
+            dst_dir = os.path.dirname(os.path.abspath(dst_path))
+            os.makedirs(dst_dir, exist_ok=True)
+            size = int(expected['size'])
+            tmp_path = f"{dst_path}.part"
+            with open(tmp_path, 'wb') as f:
+                f.truncate(size)
+
+            chunks = deque(range((size + chunk_size - 1) // chunk_size))
+            chunks_lock = Lock()
+
+            def fetch(ip, port, path):
+                with open(tmp_path, 'r+b') as f:
+                    while True:
+                        with chunks_lock:
+                            if not chunks:
+                                return True
+                            index = chunks.popleft()
+                        offset = index * chunk_size
+                        length = min(chunk_size, size - offset)
+                        try:
+                            f.seek(offset)
+                            fetch_range(ip, port, path, offset, length, f, self.security_key)
+                        except Exception:
+                            # Hand the chunk to the remaining sources and drop this one
+                            with chunks_lock:
+                                chunks.append(index)
+                            return False
+
+            # Sources that finish early may miss chunks handed back by a failing one,
+            # so keep going with the healthy sources until every chunk is written
+            while chunks and replicas:
+                with ThreadPoolExecutor(max_workers=len(replicas)) as executor:
+                    futures = [executor.submit(fetch, ip, port, path) for ip, port, path in replicas]
+                    replicas = [source for source, future in zip(replicas, futures) if future.result()]
+
+            if chunks:
+                os.remove(tmp_path)
+                return f"Error: All sources failed with {len(chunks)} chunks missing"
+            if self.file_checksum(tmp_path) != expected:
+                os.remove(tmp_path)
+                return "Error: Checksum mismatch in the downloaded file"
+            old_size = self.usage.size_of(dst_path)
+            os.replace(tmp_path, dst_path)
+            self.usage.changed(dst_path, old_size)
+            return f"Copied {size} bytes from {source_count} sources to '{dst_path}'"
+        except Exception as e:
+            return f"Error: Failed to copy file - {str(e)}"
+
+    def pull_file(self, dst_path, ip, port, src_path):
+        """Copy a file from another node by downloading it over HTTP GET
+        The content goes straight from the source node to dst_path instead of
+        through the client as an XML-RPC Binary. Failures to get the content
+        from the source are reported as "Error: Failed to download ..." so the
+        caller can try another source
+        """
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(dst_path)), exist_ok=True)
+            tmp_path = f"{dst_path}.part"
+            with open(tmp_path, 'wb') as f:
+                try:
+                    size = fetch_range(ip, port, src_path, 0, None, f, self.security_key)
+                except Exception as e:
+                    size, error = None, str(e)
+            if size is None:
+                os.remove(tmp_path)
+                return f"Error: Failed to download file from {ip}:{port} - {error}"
+            old_size = self.usage.size_of(dst_path)
+            os.replace(tmp_path, dst_path)
+            self.usage.changed(dst_path, old_size)
+            return f"Copied {size} bytes to '{dst_path}'"
+        except Exception as e:
+            return f"Error: Failed to copy file - {str(e)}"
+
+    def remote_checksum(self, ip, port, path):
+        try:
+            return xmlrpc.client.ServerProxy(f"http://{ip}:{port}").file_checksum(path)
+        except Exception as e:
+            return f"Error: Failed to connect to {ip}:{port} - {str(e)}"
+
+    def du(self, path=".", rescan=False):
+        # Sizes are sent as floats because XML-RPC integers are limited to 32 bits
+        try:
+            total, children = self.usage.usage(path, rescan)
+            return {'path': path, 'size': float(total),
+                    'dirs': [[name, float(size)] for name, size in children]}
+        except Exception as e:
+            return f"Error: Failed to get disk usage - {str(e)}"
+
+    def df(self, path="."):
+        try:
+            usage = shutil.disk_usage(path)
+            return {'total': float(usage.total), 'used': float(usage.used), 'free': float(usage.free)}
+        except Exception as e:
+            return f"Error: Failed to get disk space - {str(e)}"
+
+    def node_stats(self):
+        try:
+            load = os.getloadavg()[0] if hasattr(os, 'getloadavg') else 0.0
+            return {'free_mb': shutil.disk_usage('.').free // (1024 * 1024), 'load': load}
+        except Exception as e:
+            return f"Error: Failed to get node stats - {str(e)}"
+
+    def watch_add(self, path):
+        try:
+            if not os.path.isdir(path):
+                return f"Error: '{path}' is not a directory"
+            watch_id, backend = self.watches.add(path)
+            return {'watch_id': watch_id, 'backend': backend}
+        except Exception as e:
+            return f"Error: Failed to watch directory - {str(e)}"
+
+    def watch_poll(self, watch_id, timeout=25):
+        watch = self.watches.get(watch_id)
+        if watch is None:
+            return f"Error: Watch {watch_id} does not exist"
+        return watch.poll(min(timeout, 60))
+
+    def watch_remove(self, watch_id):
+        if self.watches.remove(watch_id):
+            return f"Watch {watch_id} removed"
+        return f"Error: Watch {watch_id} does not exist"
+
     def binary_write(self, path, binary_data):
         try:
             os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            old_size = self.usage.size_of(path)
             with open(path, 'wb') as f:
                 f.write(binary_data.data)
+            self.usage.changed(path, old_size)
             return f"File written to '{path}'"
         except Exception as e:
             return f"Error: Failed to write to file - {str(e)}"
 
 class P2PClient:
-    def __init__(self, server_address, port, hostname=None, key=None):
+    def __init__(self, server_address, port, hostname=None, key=None, interactive=True, cache=None,
+                 default_connect_port=None):
         # Parse server address and port
+        # port is the port this node listens on, which may have been picked by the
+        # operating system, so it is only the connect port if no other default is given
         if ':' in server_address:
             server_address, connect_port = server_address.split(':')
             connect_port = int(connect_port)
         else:
-            connect_port = port
+            connect_port = default_connect_port or port
         
         self.server_address = server_address
         self.connect_port = connect_port
-        self.server = xmlrpc.client.ServerProxy(f"http://{server_address}:{connect_port}", allow_none=True)
+        self.server_url = f"http://{server_address}:{connect_port}"
+        self.local = local()  # Per-thread server proxies, see the server property
+        self.interactive = interactive
+        self.cache = cache  # Optional ReadCache for files read from other nodes
         self.port = port
         self.security_key = key
         
@@ -449,46 +1647,68 @@ class P2PClient:
         # Prefer user-specified hostname, if not specified, use system hostname
         self.hostname = hostname or socket.gethostname()
         
+        # Keep stdout clean for script output; registration chatter goes to stderr
+        log = sys.stdout if self.interactive else sys.stderr
+
         # Check if hostname starts with 'id'
         if self.hostname.lower().startswith('id'):
-            print(f"Error: Hostname cannot start with 'id'")
+            print(f"Error: Hostname cannot start with 'id'", file=log)
             sys.exit(1)
         
         # Try to register multiple times if initial attempts fail
         retry_count = 0
-        max_retries = 5
+        max_retries = 8
         while retry_count < max_retries:
             try:
                 result = self.server.register_node(self.local_ip, self.port, self.hostname, self.security_key)
                 if 'error' in result:
-                    print(f"Error: {result['error']}")
+                    print(f"Error: {result['error']}", file=log)
                     if 'Hostname' in result['error'] and retry_count < max_retries - 1:
                         # Try with a different hostname
                         self.hostname = f"{self.hostname}-{retry_count + 1}"
-                        print(f"Retrying with hostname: {self.hostname}")
+                        print(f"Retrying with hostname: {self.hostname}", file=log)
                         retry_count += 1
                         continue
                     sys.exit(1)
                 self.node_id = result['id']
                 break
             except Exception as e:
-                print(f"Connection error: {str(e)}")
-                time.sleep(2)  # Wait before retry
+                print(f"Connection error: {str(e)}", file=log)
                 retry_count += 1
                 if retry_count >= max_retries:
-                    print("Maximum retry attempts reached. Exiting.")
+                    print("Maximum retry attempts reached. Exiting.", file=log)
                     sys.exit(1)
+                # Exponential backoff with jitter, so nodes started together do not retry in lockstep
+                time.sleep(min(5, 0.1 * 2 ** retry_count) * random.uniform(0.5, 1.5))
+
+        elapsed = (time.perf_counter() - START_TIME) * 1000
+        print(f"Registered as id{self.node_id} in {elapsed:.0f} ms", file=sys.stderr)
         
         # Initialize command history
         self.command_history = []
-        self.setup_readline()
+        if self.interactive:
+            self.setup_readline()
         
         # Create heartbeat thread
         self.running = True
+        self.stop_event = Event()
         self.heartbeat_thread = Thread(target=self.heartbeat_loop, daemon=True)
         self.heartbeat_thread.start()
 
+    @property
+    def server(self):
+        # ServerProxy is not thread-safe, so every thread gets its own connection
+        proxy = getattr(self.local, 'server', None)
+        if proxy is None:
+            proxy = xmlrpc.client.ServerProxy(self.server_url, allow_none=True)
+            self.local.server = proxy
+        return proxy
+
     def setup_readline(self):
+        # Imported here so headless nodes and scripts don't pay for it
+        import readline
+        self.readline = readline
+
         # Set up readline to support command history and editing features
         readline.parse_and_bind('"\\e[A": history-search-backward')  # Up arrow
         readline.parse_and_bind('"\\e[B": history-search-forward')   # Down arrow
@@ -511,15 +1731,49 @@ class P2PClient:
     def heartbeat_loop(self):
         while self.running:
             try:
-                self.server.heartbeat(self.local_ip, self.port)
-                time.sleep(10)  # Send a heartbeat every 10 seconds
+                # Pass hostname and key so the central node can re-register us if it has forgotten us
+                result = self.server.heartbeat(self.local_ip, self.port, self.hostname, self.security_key)
+                if result.get('status') == 'error':
+                    self.notify(f"Heartbeat failed: {result.get('message')}")
+                elif result.get('id', self.node_id) != self.node_id:
+                    self.node_id = result['id']
+                    self.notify(f"Re-registered with the central node as id{self.node_id}")
+                self.stop_event.wait(10)  # Send a heartbeat every 10 seconds
             except Exception as e:
                 # Print error but continue trying
-                print(f"\nHeartbeat failed: {str(e)}")
-                print(f"{self.hostname}> ", end='', flush=True)
-                time.sleep(5)  # Wait a bit before retrying after failure
+                self.notify(f"Heartbeat failed: {str(e)}")
+                self.stop_event.wait(5)  # Wait a bit before retrying after failure
 
-    def parse_path(self, path_spec, command=None):
+    def shutdown(self):
+        """Stop sending heartbeats, then unregister from the central node"""
+        self.running = False
+        self.stop_event.set()
+        if self.heartbeat_thread is not current_thread():
+            self.heartbeat_thread.join(timeout=5)
+        try:
+            self.server.unregister_node(self.local_ip, self.port)
+        except Exception:
+            pass  # Ignore unregistration errors
+
+    def node_address(self, nodes, node_id, write=print):
+        """Return [ip, port] at which other nodes can reach node_id, or None"""
+        if node_id not in nodes:
+            write(f"Error: Node {node_id} does not exist")
+            return None
+        node_info = nodes[node_id]
+        # The central node registers itself as 127.0.0.1, reach it the way we do
+        ip = self.server_address if node_info['ip'] == '127.0.0.1' else node_info['ip']
+        return [ip, node_info['port']]
+
+    def notify(self, message):
+        """Report a background event without corrupting command output"""
+        if self.interactive:
+            print(f"\n{message}")
+            print(f"{self.hostname}> ", end='', flush=True)
+        else:
+            print(message, file=sys.stderr)
+
+    def parse_path(self, path_spec, command=None, write=print):
         """Parse the specified path format, supporting ID and hostname prefixes
         For pwd command, it supports format without colon
         """
@@ -537,16 +1791,16 @@ class P2PClient:
             try:
                 node_info = self.server.get_node_by_hostname(prefix)
                 if not node_info:
-                    print(f"Error: Could not find a node with hostname '{prefix}'")
+                    write(f"Error: Could not find a node with hostname '{prefix}'")
                     return None, None
                 return node_info['id'], path
             except Exception as e:
-                print(f"Error: An error occurred while parsing the path - {str(e)}")
+                write(f"Error: An error occurred while parsing the path - {str(e)}")
                 return None, None
         
         # Normal path parsing for other commands
         if ':' not in path_spec:
-            print(f"Error: Path must include a node identifier, in the format 'idN:path' or 'hostname:path'")
+            write(f"Error: Path must include a node identifier, in the format 'idN:path' or 'hostname:path'")
             return None, None
             
         prefix, path = path_spec.split(':', 1)
@@ -560,11 +1814,11 @@ class P2PClient:
         try:
             node_info = self.server.get_node_by_hostname(prefix)
             if not node_info:
-                print(f"Error: Could not find a node with hostname '{prefix}'")
+                write(f"Error: Could not find a node with hostname '{prefix}'")
                 return None, None
             return node_info['id'], path
         except Exception as e:
-            print(f"Error: An error occurred while parsing the path - {str(e)}")
+            write(f"Error: An error occurred while parsing the path - {str(e)}")
             return None, None
 
     def run(self):
@@ -583,224 +1837,512 @@ class P2PClient:
                     continue
                     
                 # Add to command history
-                readline.add_history(cmd_input)
+                self.readline.add_history(cmd_input)
                 
-                cmd = cmd_input.split()
-                action = cmd[0]
+                self.execute_command(cmd_input)
+            except Exception as e:
+                print(f"Error: {str(e)}")
                 
-                if action == 'exit':
-                    self.running = False
-                    # Unregister node
-                    try:
-                        self.server.unregister_node(self.local_ip, self.port)
-                    except Exception:
-                        pass  # Ignore unregistration errors
-                    break
-                    
-                elif action == 'help':
-                    print(self.server.get_help())
-                    continue
-                    
-                elif action == 'client':
-                    nodes = self.server.get_nodes()
-                    print("\nConnected Nodes List:")
-                    print("-" * 60)
-                    print(f"{'ID':<5} {'Hostname':<15} {'Address':<20} {'Port':<6}")
-                    print("-" * 60)
-                    for ip, node_info in nodes.items():
-                        print(f"id{node_info['id']:<3} {node_info['hostname']:<15} {node_info['ip']:<20} {node_info['port']:<6}")
-                    print("-" * 60)
-                    continue
+        # Restore the original SIGINT handler
+        signal.signal(signal.SIGINT, original_sigint_handler)
 
-                if action in ['mkdir', 'rm', 'touch', 'ls', 'tree', 'cat']:
-                    if len(cmd) != 2:
-                        print(f"Usage: {action} NodeID:path")
-                        print(f"Example: {action} id1:/home or {action} hostname:/home")
-                        continue
-                        
-                    node_id, path = self.parse_path(cmd[1])
-                    if node_id is None:
-                        continue
-                        
-                    result = self.server.route_command(node_id, action, path)
-                    print(result)
-                elif action == 'pwd':
-                    if len(cmd) != 2:
-                        print(f"Usage: {action} NodeID")
-                        print(f"Example: {action} id1 or {action} hostname")
-                        continue
-                        
-                    node_id, path = self.parse_path(cmd[1], command='pwd')
-                    if node_id is None:
-                        continue
-                        
-                    result = self.server.route_command(node_id, action, path)
-                    print(result)
-                elif action == 'echo':
-                    if len(cmd) < 3:
-                        print("Usage: echo NodeID:path content")
-                        print("Example: echo id1:/file.txt file content or echo hostname:/file.txt file content")
-                        continue
+    def execute_command(self, cmd_input, write=print, read_line=input):
+        """Parse and execute a single command line
+        Output goes through write and continuation lines (multi-line echo, batch)
+        are pulled from read_line. Returns 0 on success and 1 on failure
+        """
+        try:
+            cmd = cmd_input.split()
+            action = cmd[0]
+            
+            if action == 'exit':
+                self.shutdown()
+                return 0
+                
+            elif action == 'help':
+                write(self.server.get_help())
+                return 0
+                
+            elif action == 'client':
+                nodes = self.server.get_nodes()
+                write("\nConnected Nodes List:")
+                write("-" * 60)
+                write(f"{'ID':<5} {'Hostname':<15} {'Address':<20} {'Port':<6}")
+                write("-" * 60)
+                for ip, node_info in nodes.items():
+                    write(f"id{node_info['id']:<3} {node_info['hostname']:<15} {node_info['ip']:<20} {node_info['port']:<6}")
+                write("-" * 60)
+                return 0
+
+            if action in ['mkdir', 'rm', 'touch', 'ls', 'tree', 'cat']:
+                if len(cmd) != 2:
+                    write(f"Usage: {action} NodeID:path")
+                    write(f"Example: {action} id1:/home or {action} hostname:/home")
+                    return 1
                     
-                    node_id, path = self.parse_path(cmd[1])
-                    if node_id is None:
-                        continue
+                node_id, path = self.parse_path(cmd[1], write=write)
+                if node_id is None:
+                    return 1
                     
-                    # Get initial content
-                    initial_content = ' '.join(cmd[2:])
+                if action == 'cat' and self.cache and node_id != self.node_id:
+                    content = self.read_file(node_id, path)
+                    if isinstance(content, str):
+                        result = content
+                    else:
+                        # Decode the same way FileManager.cat opens the file
+                        result = io.TextIOWrapper(io.BytesIO(content.data)).read()
+                else:
+                    result = self.server.route_command(node_id, action, path)
+            elif action == 'pwd':
+                if len(cmd) != 2:
+                    write(f"Usage: {action} NodeID")
+                    write(f"Example: {action} id1 or {action} hostname")
+                    return 1
                     
-                    # Initialize buffer and console state
-                    buffer = []
-                    console = list(initial_content)
-                    backtick_count = 0
-                    in_multiline = False
-                    i = 0
+                node_id, path = self.parse_path(cmd[1], command='pwd', write=write)
+                if node_id is None:
+                    return 1
                     
-                    while i < len(console):
-                        if console[i] == '\\':
-                            # Handle escape characters
-                            if i + 1 < len(console):
-                                buffer.append(console[i + 1])
-                                i += 2
-                                backtick_count = 0  # Reset backtick count
-                            else:
-                                buffer.append('\\')
-                                i += 1
-                        elif console[i] == '`':
-                            backtick_count += 1
-                            if backtick_count == 3:
-                                # Enter or exit multiline mode
-                                if not in_multiline:
-                                    # Remove the last two backticks
-                                    if len(buffer) >= 2:
-                                        buffer = buffer[:-2]
-                                    in_multiline = True
-                                else:
-                                    in_multiline = False
-                                backtick_count = 0
-                                i += 1
+                result = self.server.route_command(node_id, action, path)
+            elif action == 'echo':
+                if len(cmd) < 3:
+                    write("Usage: echo NodeID:path content")
+                    write("Example: echo id1:/file.txt file content or echo hostname:/file.txt file content")
+                    return 1
+                
+                node_id, path = self.parse_path(cmd[1], write=write)
+                if node_id is None:
+                    return 1
+                
+                # Get initial content
+                initial_content = ' '.join(cmd[2:])
+                
+                # Initialize buffer and console state
+                buffer = []
+                console = list(initial_content)
+                backtick_count = 0
+                in_multiline = False
+                i = 0
+                
+                while i < len(console):
+                    if console[i] == '\\':
+                        # Handle escape characters
+                        if i + 1 < len(console):
+                            buffer.append(console[i + 1])
+                            i += 2
+                            backtick_count = 0  # Reset backtick count
+                        else:
+                            buffer.append('\\')
+                            i += 1
+                    elif console[i] == '`':
+                        backtick_count += 1
+                        if backtick_count == 3:
+                            # Enter or exit multiline mode
+                            if not in_multiline:
+                                # Remove the last two backticks
+                                if len(buffer) >= 2:
+                                    buffer = buffer[:-2]
+                                in_multiline = True
                             else:
-                                if backtick_count < 3:
-                                   buffer.append('`')
-                                i += 1
+                                in_multiline = False
+                            backtick_count = 0
+                            i += 1
                         else:
-                            buffer.append(console[i])
-                            backtick_count = 0  # Reset backtick count
+                            if backtick_count < 3:
+                               buffer.append('`')
                             i += 1
-                    
-                    # If in multiline mode, continue collecting input
-                    if in_multiline:
-                        while True:
-                            try:
-                                line = input()
-                                console = list(line)
-                                i = 0
-                                line_buffer = []
-                                backtick_count = 0
-                                
-                                while i < len(console):
-                                    if console[i] == '\\':
-                                        if i + 1 < len(console):
-                                            line_buffer.append(console[i + 1])
-                                            i += 2
-                                            backtick_count = 0
-                                        else:
-                                            line_buffer.append('\\')
-                                            i += 1
-                                    elif console[i] == '`':
-                                        backtick_count += 1
-                                        if backtick_count == 3:
-                                            in_multiline = False
-                                            break
-                                        else:
-                                            line_buffer.append('`')
-                                        i += 1
-                                    else:
-                                        line_buffer.append(console[i])
+                    else:
+                        buffer.append(console[i])
+                        backtick_count = 0  # Reset backtick count
+                        i += 1
+                
+                # If in multiline mode, continue collecting input
+                if in_multiline:
+                    while True:
+                        try:
+                            line = read_line()
+                            console = list(line)
+                            i = 0
+                            line_buffer = []
+                            backtick_count = 0
+                            
+                            while i < len(console):
+                                if console[i] == '\\':
+                                    if i + 1 < len(console):
+                                        line_buffer.append(console[i + 1])
+                                        i += 2
                                         backtick_count = 0
+                                    else:
+                                        line_buffer.append('\\')
                                         i += 1
-                                
-                                if not in_multiline:
-                                    # Do not include the ending triple backticks
-                                    buffer.extend(['\n'] + line_buffer[:-2])
-                                    break
+                                elif console[i] == '`':
+                                    backtick_count += 1
+                                    if backtick_count == 3:
+                                        in_multiline = False
+                                        break
+                                    else:
+                                        line_buffer.append('`')
+                                    i += 1
                                 else:
-                                    buffer.extend(['\n'] + line_buffer)
-                                    
-                            except EOFError:
-                                print("Input terminated.")
+                                    line_buffer.append(console[i])
+                                    backtick_count = 0
+                                    i += 1
+                            
+                            if not in_multiline:
+                                # Do not include the ending triple backticks
+                                buffer.extend(['\n'] + line_buffer[:-2])
                                 break
-                    
-                    final_content = ''.join(buffer)
-                    
-                    result = self.server.route_command(node_id, action, path, final_content)
-                    print(result)
-                elif action in ['cp', 'mv']:
-                    if len(cmd) != 3:
-                        print(f"Usage: {action} srcNodeID:srcPath dstNodeID:dstPath")
-                        print(f"Example: {action} id1:/src.txt id2:/dst.txt or {action} hostname1:/src.txt hostname2:/dst.txt")
-                        continue
-                        
-                    src_node, src_path = self.parse_path(cmd[1])
-                    if src_node is None:
+                            else:
+                                buffer.extend(['\n'] + line_buffer)
+                                
+                        except EOFError:
+                            write("Input terminated.")
+                            break
+                
+                final_content = ''.join(buffer)
+                
+                result = self.server.route_command(node_id, action, path, final_content)
+            elif action == 'batch':
+                if len(cmd) != 2:
+                    write("Usage: batch NodeID")
+                    write("Example: batch id1 or batch hostname, then one command per line and 'end'")
+                    return 1
+
+                node_id, _ = self.parse_path(cmd[1], command='pwd', write=write)
+                if node_id is None:
+                    return 1
+
+                operations, skipped = self.read_batch_operations(write=write, read_line=read_line)
+                # A skipped line fails the batch, even if the valid operations succeed
+                status = 1 if skipped else 0
+                if not operations:
+                    return status
+
+                results = self.server.batch(node_id, operations)
+                if isinstance(results, str):
+                    write(results)
+                    return 1
+                for (op_command, op_args), op_result in zip(operations, results):
+                    write(f"[{op_command} {' '.join(op_args[:2])}] {op_result}")
+                    if self.is_error(op_result):
+                        status = 1
+                return status
+            elif action == 'du':
+                rescan = '-r' in cmd[1:]
+                targets = [arg for arg in cmd[1:] if arg != '-r']
+                if len(targets) != 1:
+                    write("Usage: du [-r] NodeID:path or du [-r] path for every node")
+                    write("Example: du id1:/data or du /data")
+                    return 1
+
+                if ':' in targets[0]:
+                    node_id, path = self.parse_path(targets[0], write=write)
+                    if node_id is None:
+                        return 1
+                    results = [{'id': node_id, 'result': self.server.route_command(node_id, 'du', path, rescan)}]
+                else:
+                    results = self.server.du_all(targets[0], rescan)
+
+                status = 0
+                for entry in results:
+                    result = entry['result']
+                    if self.is_error(result):
+                        write(f"id{entry['id']}: {result}")
+                        status = 1
                         continue
-                        
-                    dst_node, dst_path = self.parse_path(cmd[2])
-                    if dst_node is None:
+                    write(f"{format_size(result['size']):>10}  id{entry['id']}:{result['path']}")
+                    for name, size in result['dirs']:
+                        write(f"{format_size(size):>10}    {name}/")
+                return status
+            elif action == 'df':
+                if len(cmd) > 2:
+                    write("Usage: df [NodeID]")
+                    write("Example: df id1 or df for every node")
+                    return 1
+
+                if len(cmd) == 2:
+                    node_id, path = self.parse_path(cmd[1], command='pwd', write=write)
+                    if node_id is None:
+                        return 1
+                    results = [{'id': node_id, 'hostname': '', 'result': self.server.route_command(node_id, 'df', path)}]
+                else:
+                    results = self.server.df_all()
+
+                status = 0
+                write(f"{'ID':<5} {'Hostname':<15} {'Size':>10} {'Used':>10} {'Free':>10} {'Use%':>5}")
+                totals = [0.0, 0.0, 0.0]
+                for entry in results:
+                    result = entry['result']
+                    if self.is_error(result):
+                        write(f"id{entry['id']:<3} {entry['hostname']:<15} {result}")
+                        status = 1
                         continue
+                    used_pct = 100 * result['used'] / result['total'] if result['total'] else 0
+                    write(f"id{entry['id']:<3} {entry['hostname']:<15} {format_size(result['total']):>10} "
+                          f"{format_size(result['used']):>10} {format_size(result['free']):>10} {used_pct:>4.0f}%")
+                    totals = [totals[0] + result['total'], totals[1] + result['used'], totals[2] + result['free']]
+                if len(results) > 1:
+                    write(f"{'total':<21} {format_size(totals[0]):>10} {format_size(totals[1]):>10} {format_size(totals[2]):>10}")
+                return status
+            elif action == 'watch':
+                if len(cmd) not in (2, 3) or (len(cmd) == 3 and not cmd[2].isdigit()):
+                    write("Usage: watch NodeID:path [seconds]")
+                    write("Example: watch id1:/data 60 or watch hostname:/data")
+                    return 1
+
+                node_id, path = self.parse_path(cmd[1], write=write)
+                if node_id is None:
+                    return 1
+
+                subscription = self.server.watch(node_id, path)
+                if isinstance(subscription, str):
+                    write(subscription)
+                    return 1
+                watch_id = subscription['watch_id']
+                write(f"Watching '{path}' on node {node_id} ({subscription['backend']})")
+
+                deadline = time.time() + (int(cmd[2]) if len(cmd) == 3 else 30)
+                try:
+                    while self.running and time.time() < deadline:
+                        batch = self.server.watch_events(node_id, watch_id, max(1, min(25, int(deadline - time.time()))))
+                        if isinstance(batch, str):
+                            write(batch)
+                            return 1
+                        if batch['overflow']:
+                            write("Warning: Too many changes, some events were dropped")
+                        for event in batch['events']:
+                            write(f"{event['event']:<11} {event['path']}")
+                finally:
+                    self.server.unwatch(node_id, watch_id)
+                return 0
+            elif action == 'swarmcp':
+                if len(cmd) < 3:
+                    write("Usage: swarmcp srcNodeID:srcPath [srcNodeID:srcPath ...] dstNodeID:dstPath")
+                    write("Example: swarmcp id1:/data.bin id2:/data.bin id3:/data.bin")
+                    return 1
+
+                specs = []
+                for path_spec in cmd[1:]:
+                    node_id, path = self.parse_path(path_spec, write=write)
+                    if node_id is None:
+                        return 1
+                    specs.append((node_id, path))
+
+                # The destination connects to every source directly
+                nodes = {node_info['id']: node_info for node_info in self.server.get_nodes().values()}
+                sources = []
+                for node_id, path in specs[:-1]:
+                    address = self.node_address(nodes, node_id, write)
+                    if address is None:
+                        return 1
+                    sources.append(address + [path])
+
+                dst_node, dst_path = specs[-1]
+                result = self.server.route_command(dst_node, 'swarm_fetch', dst_path, sources)
+            elif action in ['cp', 'mv']:
+                if len(cmd) != 3:
+                    write(f"Usage: {action} srcNodeID:srcPath dstNodeID:dstPath")
+                    write(f"Example: {action} id1:/src.txt id2:/dst.txt or {action} hostname1:/src.txt hostname2:/dst.txt")
+                    return 1
                     
-                    if src_node == dst_node:
-                        result = self.server.route_command(src_node, action, src_path, dst_path)
-                    else:
-                        # Cross-node operation
-                        if action == 'cp':
-                            content = self.server.route_command(src_node, 'binary_read', src_path)
-                            if isinstance(content, str) and content.startswith('Error:'):
-                                print(content)
-                                continue
-                                
-                            result = self.server.route_command(dst_node, 'binary_write', dst_path, content)
-                        else:  # mv
-                            try:
-                                # 1. Read the source file content
-                                content = self.server.route_command(src_node, 'binary_read', src_path)
-                                if isinstance(content, str) and content.startswith('Error:'):
-                                    print(content)
-                                    continue
-                                
-                                # 2. Write to the target file
-                                write_result = self.server.route_command(dst_node, 'binary_write', dst_path, content)
-                                if isinstance(write_result, str) and write_result.startswith('Error:'):
-                                    print(write_result)
-                                    continue
-                                
-                                # 3. Delete the source file
-                                delete_result = self.server.route_command(src_node, 'rm', src_path)
-                                if isinstance(delete_result, str) and delete_result.startswith('Error:'):
-                                    # If deletion fails, attempt to delete the target file that was written
-                                    self.server.route_command(dst_node, 'rm', dst_path)
-                                    print(delete_result)
-                                    continue
-                                
-                                result = f"Moved '{cmd[1]}' to '{cmd[2]}'"
-                            except Exception as e:
-                                result = f"Error: Failed to move file - {str(e)}"
-                    print(result)
-                else:
-                    print(f"Error: Invalid command '{action}'")
-                    print("Enter 'help' for a list of available commands")
-
-            except xmlrpc.client.Fault as e:
-                print(f"Server error: {str(e)}")
-            except xmlrpc.client.ProtocolError as e:
-                print(f"Protocol error: {str(e)}")
-            except ConnectionRefusedError:
-                print("Error: Could not connect to the server, connection refused")
-            except Exception as e:
-                print(f"Error: {str(e)}")
+                src_node, src_path = self.parse_path(cmd[1], write=write)
+                if src_node is None:
+                    return 1
+                    
+                dst_node, dst_path = self.parse_path(cmd[2], write=write)
+                if dst_node is None:
+                    return 1
                 
-        # Restore the original SIGINT handler
-        signal.signal(signal.SIGINT, original_sigint_handler)
+                if src_node == dst_node:
+                    result = self.server.route_command(src_node, action, src_path, dst_path)
+                else:
+                    # Cross-node operation
+                    if action == 'cp':
+                        result = self.copy_file(src_node, src_path, dst_node, dst_path)
+                    else:  # mv
+                        try:
+                            # 1. Copy the file to the target node
+                            write_result = self.copy_file(src_node, src_path, dst_node, dst_path)
+                            if isinstance(write_result, str) and write_result.startswith('Error:'):
+                                write(write_result)
+                                return 1
+                            
+                            # 2. Delete the source file
+                            delete_result = self.server.route_command(src_node, 'rm', src_path)
+                            if isinstance(delete_result, str) and delete_result.startswith('Error:'):
+                                # If deletion fails, attempt to delete the target file that was written
+                                self.server.route_command(dst_node, 'rm', dst_path)
+                                write(delete_result)
+                                return 1
+                            
+                            result = f"Moved '{cmd[1]}' to '{cmd[2]}'"
+                        except Exception as e:
+                            result = f"Error: Failed to move file - {str(e)}"
+            else:
+                write(f"Error: Invalid command '{action}'")
+                write("Enter 'help' for a list of available commands")
+                return 1
+
+            write(result)
+            return 1 if self.is_error(result) else 0
+
+        except xmlrpc.client.Fault as e:
+            write(f"Server error: {str(e)}")
+        except xmlrpc.client.ProtocolError as e:
+            write(f"Protocol error: {str(e)}")
+        except ConnectionRefusedError:
+            write("Error: Could not connect to the server, connection refused")
+        except Exception as e:
+            write(f"Error: {str(e)}")
+        return 1
+
+    def copy_file(self, src_node, src_path, dst_node, dst_path):
+        """Copy a file between two nodes
+        The destination downloads the file from a source picked by the central
+        node. Nodes that cannot reach each other directly fall back to relaying
+        the content through this client
+        """
+        result = self.server.copy_file(src_node, src_path, dst_node, dst_path, self.server_address)
+        if not (isinstance(result, str) and result.startswith('Error: Failed to download')):
+            return result
+
+        # Only content that ends up on this node is worth keeping in its cache
+        content = self.read_file(src_node, src_path, cached=dst_node == self.node_id)
+        if self.is_error(content):
+            return content
+        return self.server.route_command(dst_node, 'binary_write', dst_path, content)
+
+    def read_file(self, node_id, path, cached=True):
+        """Read a file from a node, going through the local cache if enabled"""
+        if cached and self.cache and node_id != self.node_id:
+            return self.cache.read(self.server, node_id, path)
+        return self.server.route_command(node_id, 'binary_read', path)
+
+    @staticmethod
+    def is_error(result):
+        return isinstance(result, str) and result.startswith('Error')
+
+    def read_batch_operations(self, write=print, read_line=input):
+        """Read batch commands from stdin until 'end' or EOF
+        Paths are local to the batch target node, e.g. 'echo /file.txt content'.
+        Returns the operations and the number of invalid lines that were skipped
+        """
+        operations = []
+        skipped = 0
+        while True:
+            try:
+                line = read_line().strip()
+            except EOFError:
+                break
+            if line == 'end':
+                break
+            if not line or line.startswith('#'):
+                continue
+
+            parts = line.split(None, 2 if line.startswith('echo ') else -1)
+            op_command, op_args = parts[0], parts[1:]
+            if op_command not in FileManager.BATCH_COMMANDS:
+                write(f"Error: Invalid batch command '{op_command}', skipped")
+                skipped += 1
+                continue
+            if op_command == 'echo' and len(op_args) == 1:
+                op_args.append('')
+            operations.append([op_command, op_args])
+        return operations, skipped
+
+    def read_script_commands(self, stream, jsonl=False):
+        """Split a command file or JSON-lines stream into commands
+        Yields (command, error) pairs. A command is a list of lines: the
+        command itself followed by its continuation lines (multi-line echo
+        content or batch operations). Lines that cannot be parsed are yielded
+        as [line] with an error message
+        """
+        lines = iter(stream)
+        for line in lines:
+            line = line.rstrip('\n')
+            if jsonl:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError as e:
+                    yield [line], f"Error: Invalid JSON - {str(e)}"
+                    continue
+                command = entry.get('command') if isinstance(entry, dict) else entry
+                if not isinstance(command, str) or not command.strip():
+                    yield [line], "Error: Expected a command string or an object with a 'command' string"
+                    continue
+                yield command.strip().split('\n'), None
+                continue
+
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            command = [line.strip()]
+            action = command[0].split()[0]
+            if action == 'echo' and command[0].count('```') % 2 == 1:
+                for extra in lines:
+                    command.append(extra.rstrip('\n'))
+                    if '```' in extra:
+                        break
+            elif action == 'batch':
+                for extra in lines:
+                    command.append(extra.rstrip('\n'))
+                    if extra.strip() == 'end':
+                        break
+            yield command, None
+
+    def run_command_lines(self, command):
+        """Execute one scripted command and capture its output"""
+        output = []
+        continuation = iter(command[1:])
+
+        def read_line():
+            try:
+                return next(continuation)
+            except StopIteration:
+                raise EOFError
+
+        status = self.execute_command(command[0].strip(), write=lambda text: output.append(str(text)),
+                                      read_line=read_line)
+        return status, '\n'.join(output)
+
+    def run_script(self, stream, jobs=1, jsonl=False):
+        """Run commands from a stream without the interactive prompt
+        Up to `jobs` commands are in flight at once; their output is still
+        written in input order. Returns 0 if every command succeeded, else 1
+        """
+        exit_code = 0
+        pending = deque()
+
+        def flush(future, index, command):
+            nonlocal exit_code
+            status, output = future.result()
+            exit_code = exit_code or status
+            if jsonl:
+                print(json.dumps({'index': index, 'command': '\n'.join(command),
+                                  'exit_code': status, 'output': output}), flush=True)
+            else:
+                if output:
+                    print(output, flush=True)
+                if status:
+                    print(f"Command {index + 1} failed: {command[0]}", file=sys.stderr)
+
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            for index, (command, error) in enumerate(self.read_script_commands(stream, jsonl)):
+                if not self.running:
+                    break
+                if error:
+                    # Report the bad line in order with the other results and carry on
+                    pending.append((executor.submit(lambda error=error: (1, error)), index, command))
+                elif command[0].split()[0] == 'exit':
+                    break
+                else:
+                    pending.append((executor.submit(self.run_command_lines, command), index, command))
+                while len(pending) >= max(1, jobs) or (pending and pending[0][0].done()):
+                    flush(*pending.popleft())
+            while pending:
+                flush(*pending.popleft())
+        return exit_code
 
     def handle_interrupt(self, sig, frame):
         # When a Ctrl+C signal is caught, print a new line and display the command prompt
@@ -808,6 +2350,13 @@ class P2PClient:
         print(f"{self.hostname}> ", end='', flush=True)
         return
 
+def format_size(size):
+    """Format a byte count for display, e.g. 1536 -> 1.5K"""
+    for unit in ('B', 'K', 'M', 'G', 'T'):
+        if size < 1024 or unit == 'T':
+            return f"{size:.0f}{unit}" if unit == 'B' else f"{size:.1f}{unit}"
+        size /= 1024
+
 def cleanup_thread(p2p_system):
     """Thread to periodically clean up inactive nodes"""
     while True:
@@ -815,6 +2364,8 @@ def cleanup_thread(p2p_system):
             inactive_nodes = p2p_system.cleanup_inactive_nodes(timeout=120)  # Increased timeout
             if inactive_nodes:
                 print(f"Cleaned up {len(inactive_nodes)} inactive nodes")
+            # Compact the registry journal into a snapshot
+            p2p_system.snapshot_registry()
             time.sleep(30)  # Check every 30 seconds
         except Exception as e:
             print(f"Cleanup thread error: {str(e)}")
@@ -826,8 +2377,18 @@ def main():
     parser.add_argument('--connect', help='Connect to the specified server address')
     parser.add_argument('--hostname', help='Specify hostname (optional)')
     parser.add_argument('--key', help='Security key for connection verification (optional)')
+    parser.add_argument('--state-dir', help='Directory to persist the node registry in (central node only, optional)')
+    parser.add_argument('--replicas', type=int, default=0, help='Copy every written file to this many other nodes (central node only, default: 0)')
+    parser.add_argument('--cache-dir', help='Cache files read from other nodes in this directory (optional)')
+    parser.add_argument('--cache-size', type=int, default=256, help='Maximum read cache size in MB (default: 256)')
+    parser.add_argument('--script', help='Run commands from this file (or - for stdin) instead of the interactive prompt')
+    parser.add_argument('--jsonl', action='store_true', help='Read the script as JSON lines and write JSON results')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of script commands in flight at once (default: 1)')
     args = parser.parse_args()
 
+    if args.script and not args.connect:
+        parser.error('--script requires --connect')
+
     if args.connect:
         # First, start a local server
         fs = P2PFileSystem(args.port, args.key)
@@ -836,14 +2397,34 @@ def main():
         server_thread = Thread(target=fs.start_server, args=(port_specified,), daemon=True)
         server_thread.start()
         
-        # Wait a moment for the server to start
-        time.sleep(1)
+        # Wait until the server is listening, it exits on its own if no port can be bound
+        while not fs.ready.wait(0.05):
+            if not server_thread.is_alive():
+                sys.exit(1)
+
+        cache = ReadCache(args.cache_dir, args.cache_size * 1024 * 1024) if args.cache_dir else None
+        # --connect without a port uses --port as given, not the port the local server ended up on
+        connect_port = args.port or 8000
         
         # Register local node (will be done by the client)
         
         # Then, connect to the central node as a client
+        if args.script:
+            client = P2PClient(args.connect, fs.port, args.hostname, args.key, interactive=False, cache=cache,
+                               default_connect_port=connect_port)
+            try:
+                if args.script == '-':
+                    exit_code = client.run_script(sys.stdin, args.jobs, args.jsonl)
+                else:
+                    with open(args.script, 'r') as f:
+                        exit_code = client.run_script(f, args.jobs, args.jsonl)
+            finally:
+                client.shutdown()
+            sys.exit(exit_code)
+
         try:
-            client = P2PClient(args.connect, args.port, args.hostname, args.key)
+            client = P2PClient(args.connect, fs.port, args.hostname, args.key, cache=cache,
+                               default_connect_port=connect_port)
             client.run()
         except KeyboardInterrupt:
             print("\nExiting program...")
@@ -851,7 +2432,7 @@ def main():
             print(f"Client error: {str(e)}")
     else:
         # Start as the central node
-        fs = P2PFileSystem(args.port, args.key)
+        fs = P2PFileSystem(args.port, args.key, args.state_dir, args.replicas)
         
         # Register local node
         hostname = args.hostname or socket.gethostname()
@@ -859,16 +2440,22 @@ def main():
             print(f"Error: Hostname cannot start with 'id'")
             sys.exit(1)
             
-        fs.register_node('127.0.0.1', args.port, hostname, args.key)
+        # Bind first so the local node is registered with the port actually in use
+        # 检查是否指定了端口
+        port_specified = '--port' in sys.argv
+        server = fs.bind_server(port_specified)
+        result = fs.register_local_node(hostname, args.key)
+        if 'error' in result:
+            print(f"Error: {result['error']}")
+            server.server_close()
+            sys.exit(1)
         
         # Start node cleanup thread
         cleanup = Thread(target=cleanup_thread, args=(fs,), daemon=True)
         cleanup.start()
         
         try:
-            # 检查是否指定了端口
-            port_specified = '--port' in sys.argv
-            fs.start_server(port_specified)
+            fs.serve(server)
         except KeyboardInterrupt:
             print("\nServer shutting down...")
 